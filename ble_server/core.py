@@ -0,0 +1,115 @@
+"""Shared building blocks for the BLE GATT server entry points."""
+
+import bisect
+import itertools
+import math
+import os
+import struct
+
+from bumble.att import Attribute
+from bumble.gatt import Characteristic, CharacteristicValue, Service
+
+# Robot position wire format: message type byte, then x, y (mm) and the
+# angle (0.01 degree units) as little-endian int16 -- 7 bytes instead of
+# ~60 bytes of JSON, and a single DataView read on the browser side
+MSG_TYPE_ROBOT_POS = 1
+pack_robot_pos = struct.Struct("<Bhhh").pack
+
+
+def make_static_random_address():
+    """Generate a BLE static random address string (e.g. 'C5:3A:...')"""
+    bytes_ = bytearray(os.urandom(6))
+    bytes_[0] = (bytes_[0] & 0x3F) | 0xC0
+    return bytes_.hex(":").upper()
+
+
+class PositionPath:
+    """Piecewise-linear robot path sampled at fixed counter positions.
+
+    Per-segment tables (structure-of-arrays) and the position/angle
+    sample tables are all precomputed at construction time, so sample()
+    is just two list lookups on the hot path.
+
+    If the notify rate ever grows past the point where even the table
+    lookups matter (hundreds of Hz), interpolate() is the piece to
+    compile: it is already branch-light, SoA-based, and takes only
+    scalars, so it could move to numpy arrays under numba's @njit (or a
+    small Cython module) without changing callers. At 10 Hz the lookup
+    tables make that unnecessary.
+    """
+
+    def __init__(self, waypoints, num_samples=200, angle_period=40):
+        self.num_samples = num_samples
+        self.angle_period = angle_period
+
+        self._x0s = [p[0] for p in waypoints[:-1]]
+        self._y0s = [p[1] for p in waypoints[:-1]]
+        self._dxs = [b[0] - a[0] for a, b in zip(waypoints, waypoints[1:])]
+        self._dys = [b[1] - a[1] for a, b in zip(waypoints, waypoints[1:])]
+        seg_lens = [math.hypot(dx, dy) for dx, dy in zip(self._dxs, self._dys)]
+        self._inv_lens = [
+            1.0 / length if length else 0.0 for length in seg_lens
+        ]
+        self._distances = [0.0] + list(itertools.accumulate(seg_lens))
+        self._total_distance = self._distances[-1]
+
+        # Sample tables hold wire-ready integers (mm and 0.01-degree
+        # units), so the send loop never touches floating point
+        self.positions = [
+            (int(round(x)), int(round(y)))
+            for x, y in (
+                self.interpolate(k / num_samples) for k in range(num_samples)
+            )
+        ]
+        # Angle oscillates between -15 and +15 degrees, one full cycle
+        # every angle_period samples
+        self.angles = [
+            int(round(1500 * math.sin(2 * math.pi * k / angle_period)))
+            for k in range(angle_period)
+        ]
+
+    def interpolate(self, progress):
+        """Interpolate position along the waypoints. progress: 0.0 to 1.0"""
+        target_distance = progress * self._total_distance
+
+        # Find current segment (binary search runs in C)
+        i = min(
+            bisect.bisect_right(self._distances, target_distance) - 1,
+            len(self._distances) - 2,
+        )
+        segment_progress = (
+            target_distance - self._distances[i]
+        ) * self._inv_lens[i]
+        x = self._x0s[i] + segment_progress * self._dxs[i]
+        y = self._y0s[i] + segment_progress * self._dys[i]
+        return x, y
+
+    def sample(self, counter):
+        """Return (x_mm, y_mm, angle_centideg) ints for a counter value"""
+        x, y = self.positions[counter % self.num_samples]
+        return x, y, self.angles[counter % self.angle_period]
+
+
+def build_service(service_uuid, tx_uuid, rx_uuid, on_rx_write):
+    """Create the GATT service and return (service, tx_char, rx_char)"""
+    tx_char = Characteristic(
+        tx_uuid,
+        properties=(
+            Characteristic.Properties.READ | Characteristic.Properties.NOTIFY
+        ),
+        permissions=(Attribute.Permissions.READABLE),
+        value=b"Hello from Bumble!",
+    )
+
+    rx_char = Characteristic(
+        rx_uuid,
+        properties=(
+            Characteristic.Properties.WRITE
+            | Characteristic.Properties.WRITE_WITHOUT_RESPONSE
+        ),
+        permissions=(Attribute.Permissions.WRITEABLE),
+        value=CharacteristicValue(write=on_rx_write),
+    )
+
+    service = Service(service_uuid, [tx_char, rx_char])
+    return service, tx_char, rx_char
@@ -1,22 +1,57 @@
 import asyncio
-import json
 import logging
-import math
 import random
 
-from bumble.att import Attribute
 from bumble.core import AdvertisingData
 from bumble.device import Device
-from bumble.gatt import Characteristic, CharacteristicValue, Service
-from bumble.hci import Address
+from bumble.hci import (
+    HCI_LE_2M_PHY,
+    Address,
+    HCI_LE_Set_Data_Length_Command,
+)
 from bumble.transport import open_transport
 
+from ble_server.core import (
+    MSG_TYPE_ROBOT_POS,
+    PositionPath,
+    build_service,
+    make_static_random_address,
+    pack_robot_pos,
+)
+
 logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
 SERVICE_UUID = "845d1d9a-b986-45b8-8b0e-21ee94307983"
 TX_CHARACTERISTIC_UUID = "3ecd3272-0f80-4518-ad58-78aa9af3ec9d"
 RX_CHARACTERISTIC_UUID = "47153006-9eef-45e5-afb7-038ea60ad893"
 
+# Waypoints for the smooth robot path; sampled at 200 points per cycle
+# (one cycle every 20 seconds at 100ms per message), with the angle
+# oscillating once every 40 messages
+WAYPOINTS = [
+    (388, 388),
+    (388, 6500),
+    (1100, 6500),
+    (1100, 1400),
+    (1900, 1400),
+    (1900, 6500),
+    (2500, 6500),
+    (2500, 388),
+    (388, 388),
+]
+
+
+# RX write handler (receive writes from browser); needs no connection
+# state, so it lives at module scope and is compiled once at import
+def on_rx_write(connection, value):
+    try:
+        text = value.decode("utf-8")
+    except UnicodeDecodeError:
+        print(f"=== [Received] Binary data: {value.hex()}")
+        return
+    print(f"=== [Received] Write from browser: {text}")
+
 
 async def main():
     print("Starting BLE GATT Server...")
@@ -29,12 +64,6 @@ async def main():
         # Generate a random device name
         target_name = f"Hojicha_{random.randint(0, 9999):04d}"
 
-        # Generate a static random address
-        def make_static_random_address():
-            bytes_ = bytearray(random.getrandbits(8) for _ in range(6))
-            bytes_[0] = (bytes_[0] & 0x3F) | 0xC0
-            return ":".join(f"{b:02X}" for b in bytes_)
-
         rand_addr = make_static_random_address()
         print(f"=== Using address: {rand_addr}")
         device = Device.with_hci(
@@ -45,119 +74,130 @@ async def main():
         )
 
         # Create GATT table (services and characteristics)
-
-        # RX write handler (receive writes from browser)
-        def on_rx_write(connection, value):
-            try:
-                text = value.decode("utf-8")
-                print(f"=== [Received] Write from browser: {text}")
-            except:
-                print(f"=== [Received] Binary data: {value.hex()}")
-
-        # Define characteristics
-        tx_char = Characteristic(
-            TX_CHARACTERISTIC_UUID,
-            properties=(
-                Characteristic.Properties.READ | Characteristic.Properties.NOTIFY
-            ),
-            permissions=(Attribute.Permissions.READABLE),
-            value=b"Hello from Bumble!",
-        )
-
-        rx_char = Characteristic(
-            RX_CHARACTERISTIC_UUID,
-            properties=(
-                Characteristic.Properties.WRITE
-                | Characteristic.Properties.WRITE_WITHOUT_RESPONSE
-            ),
-            permissions=(Attribute.Permissions.WRITEABLE),
-            value=CharacteristicValue(write=on_rx_write),
+        service_element, tx_char, rx_char = build_service(
+            SERVICE_UUID, TX_CHARACTERISTIC_UUID, RX_CHARACTERISTIC_UUID,
+            on_rx_write,
         )
-
-        # Define service
-        service_element = Service(SERVICE_UUID, [tx_char, rx_char])
         device.add_service(service_element)
 
+        # Precompute the path sample tables once for the whole server
+        path = PositionPath(WAYPOINTS)
+
         # Manage message sending task
         send_task = None
 
-        async def send_messages_periodically():
+        async def send_messages_periodically(connection):
             """Send robot position data every 100ms"""
-            # Define waypoints for smooth path
-            waypoints = [
-                (388, 388),
-                (388, 6500),
-                (1100, 6500),
-                (1100, 1400),
-                (1900, 1400),
-                (1900, 6500),
-                (2500, 6500),
-                (2500, 388),
-                (388, 388),
-            ]
-
-            # Calculate total distance for interpolation
-            def distance(p1, p2):
-                return math.sqrt((p2[0] - p1[0]) ** 2 + (p2[1] - p1[1]) ** 2)
-
-            def interpolate_path(waypoints, progress):
-                """Interpolate position along waypoints. progress: 0.0 to 1.0"""
-                # Calculate cumulative distances
-                distances = [0.0]
-                for i in range(len(waypoints) - 1):
-                    distances.append(
-                        distances[-1] + distance(waypoints[i], waypoints[i + 1])
-                    )
-
-                total_distance = distances[-1]
-                target_distance = progress * total_distance
-
-                # Find current segment
-                for i in range(len(distances) - 1):
-                    if distances[i] <= target_distance <= distances[i + 1]:
-                        segment_progress = (
-                            (target_distance - distances[i])
-                            / (distances[i + 1] - distances[i])
-                            if distances[i + 1] != distances[i]
-                            else 0
-                        )
-                        p1 = waypoints[i]
-                        p2 = waypoints[i + 1]
-                        x = p1[0] + segment_progress * (p2[0] - p1[0])
-                        y = p1[1] + segment_progress * (p2[1] - p1[1])
-                        return x, y
-
-                return waypoints[-1]
-
+            # Latest-wins handoff between the sampler and the notifier: if
+            # a new sample lands before the previous notify has flushed,
+            # it overwrites the pending one, so the TX queue stays bounded
+            # and the browser always gets the freshest position
+            pending = None
+            pending_ready = asyncio.Event()
+
+            async def notify_pending():
+                nonlocal pending
+                # Bind hot lookups to locals (LOAD_FAST instead of
+                # LOAD_GLOBAL/LOAD_ATTR on every iteration)
+                _wait = pending_ready.wait
+                _clear = pending_ready.clear
+                _notify = device.notify_subscribers
+                _debug = logger.debug
+                # notify_subscribers only enqueues into the host's ACL
+                # packet queue and returns immediately, so the real TX
+                # gate is the queue's per-connection in-flight tracking
+                queue = device.host.get_data_packet_queue(connection.handle)
+                while True:
+                    await _wait()
+                    _clear()
+                    message = pending
+                    pending = None
+                    tx_char.value = message
+                    await _notify(tx_char)
+                    if queue is not None:
+                        # Hold the next notify until the controller has
+                        # taken this one, so our backlog never exceeds
+                        # one packet no matter how slow the link is
+                        await queue.drain(connection.handle)
+                    # Per-message tracing only at DEBUG; stdout writes in
+                    # the notify path cause latency spikes at 10 Hz
+                    _debug("[Sent] %s", message)
+
+            notify_task = asyncio.create_task(notify_pending())
             message_counter = 0
+            last_message = None
+            loop = asyncio.get_running_loop()
+            # Same local-binding treatment for the sampler loop
+            _sample = path.sample
+            _pack = pack_robot_pos
+            _set_ready = pending_ready.set
+            _sleep = asyncio.sleep
+            _now = loop.time
+            next_t = _now()
             try:
                 while True:
                     message_counter += 1
 
-                    # Calculate position along the path (cycles every 20 seconds)
-                    # 100ms per message, so 200 messages per cycle
-                    progress = (message_counter % 200) / 200.0
-                    x, y = interpolate_path(waypoints, progress)
-
-                    # Calculate angle (oscillates between -15 and +15 degrees)
-                    # Complete oscillation every 40 messages
-                    angle = 15 * math.sin(2 * math.pi * message_counter / 40)
-
-                    # Create JSON message
-                    data = {
-                        "type": "robot_pos",
-                        "x": round(x, 2),
-                        "y": round(y, 2),
-                        "angle": round(angle, 2),
-                    }
-                    message = json.dumps(data).encode("utf-8")
-                    tx_char.value = message
-                    await device.notify_subscribers(tx_char)
-                    print(f"=== [Sent] {message.decode('utf-8')}")
-                    await asyncio.sleep(0.1)  # 100ms interval
+                    # Position and angle come out of the precomputed tables
+                    # as wire-ready integers; no float math on this path
+                    x, y, angle = _sample(message_counter)
+
+                    # Pack the binary message; skip the notify entirely
+                    # when the payload hasn't changed since last tick
+                    message = _pack(MSG_TYPE_ROBOT_POS, x, y, angle)
+                    if message != last_message:
+                        last_message = message
+                        pending = message
+                        _set_ready()
+                    # Sleep until the next 100ms deadline rather than for a
+                    # fixed 100ms, so the work time doesn't accumulate drift
+                    next_t += 0.1
+                    delay = next_t - _now()
+                    if delay > 0:
+                        await _sleep(delay)
+                    else:
+                        # Fell behind (GC pause, stack stall); re-baseline
+                        next_t = _now()
             except asyncio.CancelledError:
                 print("=== Stopped sending messages")
                 raise
+            finally:
+                notify_task.cancel()
+
+        async def request_fast_connection(connection):
+            """Ask for a short connection interval to cut notify latency"""
+            try:
+                # update_parameters takes milliseconds and converts to
+                # HCI units itself
+                await connection.update_parameters(
+                    connection_interval_min=7.5,
+                    connection_interval_max=15,
+                    max_latency=0,
+                    supervision_timeout=2000,  # 2s
+                )
+            except Exception as error:
+                print(f"=== Connection parameter update failed: {error}")
+
+            # Prefer the 2M PHY so each connection event carries more data
+            try:
+                await connection.set_phy(
+                    tx_phys=[HCI_LE_2M_PHY], rx_phys=[HCI_LE_2M_PHY]
+                )
+            except Exception as error:
+                print(f"=== PHY update failed: {error}")
+
+            # Ask for data length extension so a whole payload fits in a
+            # single LL PDU instead of being fragmented at 27 bytes
+            try:
+                await device.send_command(
+                    HCI_LE_Set_Data_Length_Command(
+                        connection_handle=connection.handle,
+                        tx_octets=251,
+                        tx_time=2120,
+                    )
+                )
+            except Exception as error:
+                print(f"=== Data length update failed: {error}")
 
         def on_connection(connection):
             """Connection callback"""
@@ -165,8 +205,9 @@ async def main():
             print(f"=== Client connected: {connection}")
             # Also listen on the connection object to ensure cleanup fires
             connection.on("disconnection", on_disconnection)
-            # Start message sending task
-            send_task = asyncio.create_task(send_messages_periodically())
+            # The central usually picks a 30-50ms default interval; request
+            # a shorter one so notifies get more TX opportunities
+            asyncio.create_task(request_fast_connection(connection))
 
         def on_disconnection(connection):
             """Disconnection callback"""
@@ -177,22 +218,42 @@ async def main():
                 send_task.cancel()
             send_task = None
 
-        # Register event handlers
+        def on_tx_subscription(connection, notify_enabled, indicate_enabled):
+            """CCCD write callback: only send while someone is listening"""
+            nonlocal send_task
+            if notify_enabled:
+                print(f"=== Notifications enabled: {connection}")
+                if send_task is None or send_task.done():
+                    send_task = asyncio.create_task(
+                        send_messages_periodically(connection)
+                    )
+            else:
+                print(f"=== Notifications disabled: {connection}")
+                if send_task and not send_task.done():
+                    send_task.cancel()
+                send_task = None
+
+        # Register event handlers; the send task is driven by the CCCD
+        # subscription state rather than the connection itself, so idle
+        # connections don't pay for 10 Hz notifies nobody receives
         device.on("connection", on_connection)
         device.on("disconnection", on_disconnection)
+        tx_char.on("subscription", on_tx_subscription)
 
         # Start server
         print(f"=== Server started: {device.name}")
         await device.power_on()
 
-        # Explicitly create advertising data (information visible when scanned)
-        advertising_data = AdvertisingData(
-            [(AdvertisingData.COMPLETE_LOCAL_NAME, bytes(target_name, "utf-8"))]
+        # Explicitly create advertising data (information visible when
+        # scanned); serialize it once up front so auto-restart reuses the
+        # cached bytes instead of re-packing the TLVs
+        name_bytes = target_name.encode("utf-8")
+        adv_bytes = bytes(
+            AdvertisingData([(AdvertisingData.COMPLETE_LOCAL_NAME, name_bytes)])
         )
 
-        # Explicitly create advertising data (information visible when scanned)
         await device.start_advertising(
-            advertising_data=bytes(advertising_data), auto_restart=True
+            advertising_data=adv_bytes, auto_restart=True
         )
 
         print("=== Advertising... Please connect from the browser")
@@ -202,6 +263,15 @@ async def main():
 
 
 if __name__ == "__main__":
+    # uvloop cuts per-callback event loop overhead roughly in half;
+    # fall back to the default loop when it isn't installed
+    try:
+        import uvloop
+
+        uvloop.install()
+    except ImportError:
+        pass
+
     try:
         asyncio.run(main())
     except KeyboardInterrupt: